@@ -1,23 +1,72 @@
 # main.py
 import os
+import sys
 import uuid
-import json
+import errno
+import importlib.util
+import queue
 import shutil
-from pathlib import Path
-from typing import Dict, List, Any
-
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import nullcontext
+from functools import lru_cache
+from pathlib import Path, PurePosixPath
+from types import SimpleNamespace
+from typing import Dict, List, Any, Iterator, Optional, Tuple
+
+import aiofiles
 import cv2
-from fastapi import FastAPI, UploadFile, File, Request, HTTPException, Body
-from fastapi.responses import JSONResponse, HTMLResponse
+import numpy as np
+import orjson
+from fastapi import FastAPI, UploadFile, File, Form, Request, HTTPException, Body, BackgroundTasks
+from fastapi.responses import JSONResponse, HTMLResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 
+try:
+    import fcntl  # POSIX only; used to serialize the TensorRT export across workers
+except ImportError:
+    fcntl = None
+
+try:
+    import torch
+except Exception:
+    torch = None
+
+try:
+    import torchvision.io
+except Exception:
+    torchvision = None
+
+# Numba (optional) JIT for the per-frame box filter; NumPy version is used without it
+try:
+    from numba import njit
+except Exception:
+    njit = None
+
+# PyAV (optional) for NVDEC hardware decode, see VIDEO_DECODER
+try:
+    import av
+    from av.codec.hwaccel import HWAccel
+except Exception:
+    av = None
+
 # ultralytics YOLO (may require installation of ultralytics package)
 try:
     from ultralytics import YOLO
 except Exception:
     YOLO = None
 
+try:
+    from ultralytics.trackers.byte_tracker import BYTETracker
+except Exception:
+    BYTETracker = None
+
 # ------------------------------
 # Path configuration (YOUR layout)
 # ------------------------------
@@ -35,17 +84,146 @@ TEMPLATES_DIR = FRONTEND_DIR / "templates"                    # frontend templat
 for p in (UPLOADS_DIR, ANNOTATIONS_DIR, PERSONS_DB, TEMP_ROOT, STATIC_DIR, TEMPLATES_DIR):
     p.mkdir(parents=True, exist_ok=True)
 
+TEMP_ROOT_RESOLVED = TEMP_ROOT.resolve()                      # resolved once for path checks
+
 # ------------------------------
 # YOLO model
 # ------------------------------
 MODEL_WEIGHTS = BACKEND_DIR / "yolov8n.pt"   # ensure file exists
+
+# Frames per batched forward pass (override with YOLO_BATCH env var)
+YOLO_BATCH = max(1, int(os.environ.get("YOLO_BATCH", "16")))
+
+# TensorRT engine, exported by the first CUDA job. Its max batch is baked in, so the file name carries
+# YOLO_BATCH: raising YOLO_BATCH exports a new engine instead of reusing one built for smaller batches.
+MODEL_ENGINE = BACKEND_DIR / f"yolov8n_b{YOLO_BATCH}.engine"
+
+# Inference placement: FP16 on the first GPU when CUDA is available, FP32 on CPU otherwise
+USE_CUDA = torch is not None and torch.cuda.is_available()
+PREDICT_KWARGS: Dict[str, Any] = {"half": True, "device": 0} if USE_CUDA else {}
+
+# Rough GPU memory per frame in a batch (3 x 640 x 640 activations, fp16, ~4x for intermediate maps)
+FRAME_VRAM_BYTES = 3 * 640 * 640 * 2 * 4
+
+# Video decoder: "opencv" (CPU, default) or "nvdec" (PyAV with CUDA hwaccel, falls back to OpenCV)
+VIDEO_DECODER = os.environ.get("VIDEO_DECODER", "opencv").lower()
+
+# ByteTrack settings, passed straight to BYTETracker (no bytetrack.yaml lookup/parse per video).
+# Values match the stock ultralytics bytetrack.yaml so tracking (and recall) is unchanged.
+TRACKER_ARGS = SimpleNamespace(
+    tracker_type="bytetrack",
+    track_high_thresh=0.25,  # first-association detection threshold
+    track_low_thresh=0.1,    # second-association (low score) threshold
+    new_track_thresh=0.25,   # min score to start a new track
+    track_buffer=30,         # frames a lost track is kept
+    match_thresh=0.8,        # IoU matching threshold
+    fuse_score=True,         # fuse detection score into the matching cost
+)
+
 if YOLO is None:
     print("WARNING: ultralytics package not available. Install `pip install ultralytics` to enable detection.")
-    model = None
-else:
-    if not MODEL_WEIGHTS.exists():
-        print(f"WARNING: Model weights not found at {MODEL_WEIGHTS}. Place yolov8n.pt here for detection.")
-    model = YOLO(str(MODEL_WEIGHTS)) if MODEL_WEIGHTS.exists() else None
+elif not MODEL_WEIGHTS.exists():
+    print(f"WARNING: Model weights not found at {MODEL_WEIGHTS}. Place yolov8n.pt here for detection.")
+
+
+def export_engine() -> None:
+    """Export MODEL_ENGINE once across worker processes: exports are serialized on a lock file, and the
+    engine is built in a scratch dir and renamed into place, so no worker ever loads a half-written file"""
+    with open(MODEL_ENGINE.with_name(MODEL_ENGINE.name + ".lock"), "w") as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        if MODEL_ENGINE.exists():
+            return  # another worker exported it while we waited
+        # the scratch dir also holds the intermediate .onnx, which is removed with it
+        with tempfile.TemporaryDirectory(dir=BACKEND_DIR) as tmp:
+            weights = Path(tmp) / MODEL_WEIGHTS.name
+            shutil.copy2(MODEL_WEIGHTS, weights)
+            exported = YOLO(str(weights)).export(format="engine", half=True, dynamic=True, batch=YOLO_BATCH, imgsz=640)
+            os.replace(exported, MODEL_ENGINE)
+
+
+@lru_cache(maxsize=1)
+def get_model():
+    """Load the detector once per process (video jobs run in worker processes, each with its own CUDA context)"""
+    if YOLO is None or not MODEL_WEIGHTS.exists():
+        return None
+    if not USE_CUDA:
+        print("WARNING: CUDA not available; detection runs in FP32 on CPU.")
+        return YOLO(str(MODEL_WEIGHTS))
+
+    # Prefer a TensorRT FP16 engine on CUDA; exported once next to the weights, reused on later boots.
+    # Without tensorrt/onnx installed ultralytics would pip-install them mid-job, so use PyTorch instead.
+    needed = ("tensorrt",) if MODEL_ENGINE.exists() else ("tensorrt", "onnx")
+    missing = [m for m in needed if importlib.util.find_spec(m) is None]
+    if missing:
+        print(f"WARNING: {', '.join(missing)} not installed; skipping TensorRT and using PyTorch weights.")
+    else:
+        try:
+            if not MODEL_ENGINE.exists():
+                export_engine()
+            return YOLO(str(MODEL_ENGINE), task="detect")
+        except Exception as e:
+            print(f"WARNING: TensorRT export/load failed ({e}). Falling back to PyTorch weights.")
+
+    # PyTorch on GPU: fuse conv+bn once up front; PREDICT_KWARGS (half=True) runs it in FP16
+    model = YOLO(str(MODEL_WEIGHTS))
+    model.fuse()
+    model.to("cuda")
+    return model
+
+
+# ------------------------------
+# Crop encoding + background writer
+# ------------------------------
+JPEG_QUALITY = 85
+# CPU (OpenCV) encode flags: fixed quality, no extra Huffman-optimisation pass
+JPEG_PARAMS = [int(cv2.IMWRITE_JPEG_QUALITY), JPEG_QUALITY, int(cv2.IMWRITE_JPEG_OPTIMIZE), 0]
+
+if "libjpeg-turbo" not in cv2.getBuildInformation():
+    print("WARNING: OpenCV is not built with libjpeg-turbo; CPU JPEG encoding will be slow. "
+          "Install the opencv-python-headless wheel from PyPI.")
+
+# GPU crop + nvJPEG encode (torchvision >= 0.19 on CUDA); CPU OpenCV encode otherwise.
+# encode_crops clears this after the first GPU failure.
+USE_GPU_JPEG = torchvision is not None and USE_CUDA
+
+# Encoded crops are queued here and written by daemon threads so disk I/O does not stall detection.
+# The bound keeps memory in check when the writers fall behind (producers block on put).
+# Each item carries its job's failure list, which collects the paths that could not be written.
+N_WRITERS = 4
+crop_queue: "queue.Queue[tuple[Path, bytes, List[Path]]]" = queue.Queue(maxsize=1000)
+
+
+def _crop_writer():
+    while True:
+        path, buf, failed = crop_queue.get()
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(buf)
+        except Exception as e:
+            print(f"WARNING: failed to write crop {path}: {e}")
+            failed.append(path)
+        finally:
+            crop_queue.task_done()
+
+
+for _ in range(N_WRITERS):
+    threading.Thread(target=_crop_writer, daemon=True).start()
+
+# ------------------------------
+# Video job workers
+# ------------------------------
+# Video processing is CPU/GPU bound, so it runs in worker processes instead of on the event loop.
+# "spawn" keeps CUDA usable in the workers; override the pool size with VIDEO_WORKERS.
+VIDEO_WORKERS = max(1, int(os.environ.get("VIDEO_WORKERS", "2")))
+
+
+def make_video_pool() -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(max_workers=VIDEO_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
+
+video_pool = make_video_pool()
+video_pool_lock = threading.Lock()  # guards replacing a broken pool
 
 # ------------------------------
 # FastAPI app + mounts
@@ -60,6 +238,23 @@ app.mount("/persons", StaticFiles(directory=str(PERSONS_DB)), name="persons")
 templates = Jinja2Templates(directory=str(TEMPLATES_DIR))
 
 
+@app.on_event("startup")
+def fail_interrupted_jobs():
+    """Jobs still "pending" when the server starts were lost with the previous process; mark them failed.
+
+    Runs only in the server process (worker processes import this module but never start the app).
+    """
+    for path in ANNOTATIONS_DIR.glob("*_status.json"):
+        try:
+            job = orjson.loads(path.read_bytes())
+        except Exception:
+            continue
+        if job.get("status") == "pending":
+            session_id = job.get("session_id") or path.name[: -len("_status.json")]
+            shutil.rmtree(TEMP_ROOT / session_id, ignore_errors=True)
+            write_status(session_id, "error", detail="Processing was interrupted by a server restart")
+
+
 @app.get("/", response_class=JSONResponse)
 def root():
     return {"message": "Annotation backend running", "ui": "/ui"}
@@ -76,24 +271,237 @@ def ui(request: Request):
 # ------------------------------
 def safe_temp_session_path(session_id: str) -> Path:
     path = (TEMP_ROOT / session_id).resolve()
-    if not str(path).startswith(str(TEMP_ROOT.resolve())):
+    # must be a direct child of TEMP_ROOT (rejects "", ".", ".." and anything that resolves elsewhere)
+    if path.parent != TEMP_ROOT_RESOLVED:
         raise HTTPException(status_code=400, detail="Invalid session path")
     return path
 
 
+def safe_temp_path(session_id: str, *parts: str, detail: str = "Invalid path") -> Path:
+    """Resolve TEMP_ROOT/<session_id>/<parts...>, rejecting anything outside that session folder"""
+    session = safe_temp_session_path(session_id)
+    path = session.joinpath(*parts).resolve()
+    if path == session or not path.is_relative_to(session):
+        raise HTTPException(status_code=400, detail=detail)
+    return path
+
+
+def parse_temp_web_path(web_path: str, detail: str) -> Tuple[str, str, str]:
+    """Split a /temp/<session_id>/<person>/<filename> web path into its three parts (400 with `detail` otherwise)"""
+    parts = PurePosixPath(web_path).parts
+    if len(parts) != 5 or ".." in parts:
+        raise HTTPException(status_code=400, detail=detail)
+    _, _, session_id, person, filename = parts
+    return session_id, person, filename
+
+
+def _opencv_frames(cap, stride: int) -> Iterator[Tuple[int, np.ndarray]]:
+    try:
+        frame_idx = 0
+        while True:
+            if frame_idx % stride == 0:
+                ret, frame = cap.read()
+                if not ret:
+                    break
+                yield frame_idx, frame
+            elif not cap.grab():  # skipped frames are not converted to BGR
+                break
+            frame_idx += 1
+    finally:
+        cap.release()
+
+
+def _pyav_frames(container, stride: int) -> Iterator[Tuple[int, np.ndarray]]:
+    try:
+        for frame_idx, frame in enumerate(container.decode(video=0)):
+            if frame_idx % stride == 0:
+                # decoded surfaces are downloaded from the GPU here; detection expects BGR ndarrays
+                yield frame_idx, frame.to_ndarray(format="bgr24")
+    finally:
+        container.close()
+
+
+def open_video(path: Path, target_fps: float = 0) -> Tuple[float, int, Iterator[Tuple[int, np.ndarray]]]:
+    """
+    Open a video with the decoder selected by VIDEO_DECODER.
+    Returns (fps, stride, generator of (frame_idx, BGR frame)) where only every stride-th frame is yielded,
+    stride = fps // target_fps (every frame when target_fps <= 0 or fps is unknown); fps is 0 if unknown.
+    """
+    def stride_for(fps: float) -> int:
+        return max(1, int(fps / target_fps)) if target_fps > 0 and fps > 0 else 1
+
+    if VIDEO_DECODER == "nvdec":
+        if av is None:
+            print("WARNING: VIDEO_DECODER=nvdec but PyAV is not installed (`pip install av`). Using OpenCV.")
+        else:
+            container = None
+            try:
+                container = av.open(str(path), hwaccel=HWAccel(device_type="cuda", allow_software_fallback=True))
+                fps = float(container.streams.video[0].average_rate or 0)
+                stride = stride_for(fps)
+                return fps, stride, _pyav_frames(container, stride)
+            except Exception as e:
+                if container is not None:
+                    container.close()
+                print(f"WARNING: NVDEC decode unavailable ({e}). Using OpenCV.")
+    cap = cv2.VideoCapture(str(path))
+    if not cap.isOpened():
+        # corrupt or non-video upload: fail the job instead of finishing it with zero frames
+        cap.release()
+        raise RuntimeError(f"could not open video {path.name}")
+    fps = cap.get(cv2.CAP_PROP_FPS) or 0
+    stride = stride_for(fps)
+    return fps, stride, _opencv_frames(cap, stride)
+
+
+def iter_batches(frames: Iterator[Tuple[int, np.ndarray]], size: int) -> Iterator[Tuple[List[np.ndarray], List[int]]]:
+    """Group (frame_idx, frame) pairs into (frames, frame_ids) batches of `size`; the last batch may be partial"""
+    buf: List[np.ndarray] = []
+    buf_ids: List[int] = []
+    for frame_idx, frame in frames:
+        buf.append(frame)
+        buf_ids.append(frame_idx)
+        if len(buf) == size:
+            yield buf, buf_ids
+            buf, buf_ids = [], []
+    if buf:
+        yield buf, buf_ids
+
+
+def pick_batch_size() -> int:
+    """YOLO_BATCH, reduced to what fits in currently free GPU memory (YOLO_BATCH as-is without CUDA)"""
+    if not USE_CUDA:
+        return YOLO_BATCH
+    try:
+        free, _ = torch.cuda.mem_get_info()
+    except Exception:
+        return YOLO_BATCH
+    return int(min(YOLO_BATCH, max(1, free // FRAME_VRAM_BYTES)))
+
+
+def _filter_boxes_numpy(xyxy: np.ndarray, w: int, h: int, min_area: int) -> Tuple[np.ndarray, np.ndarray]:
+    # clip against an int32 bound so the result stays int32 (a Python list would promote to int64)
+    boxes = np.clip(xyxy.astype(np.int32), 0, np.array([w - 1, h - 1, w - 1, h - 1], dtype=np.int32))
+    wh = boxes[:, 2:] - boxes[:, :2]
+    keep = (wh[:, 0] > 0) & (wh[:, 1] > 0) & (wh[:, 0] * wh[:, 1] >= min_area)
+    return np.flatnonzero(keep), boxes
+
+
+if njit is not None:
+    @njit(cache=True)
+    def _filter_boxes_numba(xyxy, w, h, min_area):
+        n = xyxy.shape[0]
+        boxes = np.empty((n, 4), np.int32)
+        keep = np.zeros(n, np.bool_)
+        for i in range(n):
+            x1 = min(max(int(xyxy[i, 0]), 0), w - 1)
+            y1 = min(max(int(xyxy[i, 1]), 0), h - 1)
+            x2 = min(max(int(xyxy[i, 2]), 0), w - 1)
+            y2 = min(max(int(xyxy[i, 3]), 0), h - 1)
+            boxes[i, 0] = x1
+            boxes[i, 1] = y1
+            boxes[i, 2] = x2
+            boxes[i, 3] = y2
+            bw = x2 - x1
+            bh = y2 - y1
+            keep[i] = bw > 0 and bh > 0 and bw * bh >= min_area
+        return np.nonzero(keep)[0], boxes
+
+
+def filter_boxes(xyxy: np.ndarray, w: int, h: int, min_area: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Clamp (N, 4) xyxy boxes to the frame and drop empty/tiny ones; returns (kept indices, clamped int32 boxes)"""
+    if njit is None:
+        return _filter_boxes_numpy(xyxy, w, h, min_area)
+    return _filter_boxes_numba(np.ascontiguousarray(xyxy), int(w), int(h), int(min_area))
+
+
+# compile the kernel at import, not on the first video; detector boxes and BYTETracker.update rows are both float32
+if njit is not None:
+    filter_boxes(np.zeros((1, 4), np.float32), 2, 2, 1)
+
+
+def encode_crops(frame, boxes: List[Tuple[int, int, int, int]]) -> List[Optional[bytes]]:
+    """JPEG-encode frame[y1:y2, x1:x2] for each (x1, y1, x2, y2) box; None where encoding failed.
+
+    With CUDA + torchvision the frame is uploaded once, cropped on the GPU and batch-encoded
+    with nvJPEG; otherwise (or if that fails) each crop is encoded on the CPU with OpenCV.
+    """
+    global USE_GPU_JPEG
+    if USE_GPU_JPEG:
+        try:
+            # HWC BGR uint8 -> CHW RGB on the GPU
+            frame_gpu = torch.from_numpy(frame).to("cuda", non_blocking=True).permute(2, 0, 1)[[2, 1, 0]]
+            crops = [frame_gpu[:, y1:y2, x1:x2].contiguous() for x1, y1, x2, y2 in boxes]
+            jpegs = torchvision.io.encode_jpeg(crops, quality=JPEG_QUALITY)
+            return [j.cpu().numpy().tobytes() for j in jpegs]
+        except Exception as e:
+            # don't pay an upload + exception on every frame: use the CPU path for the rest of this process
+            print(f"WARNING: GPU JPEG encode failed ({e}). Using OpenCV CPU encoding from now on.")
+            USE_GPU_JPEG = False
+    out: List[Optional[bytes]] = []
+    for x1, y1, x2, y2 in boxes:
+        ok, buf = cv2.imencode(".jpg", frame[y1:y2, x1:x2], JPEG_PARAMS)
+        out.append(buf.tobytes() if ok else None)
+    return out
+
+
+def move_tree(src: Path, dest: Path) -> None:
+    """Move a directory tree: a metadata-only rename on the same filesystem, a copy + delete across devices"""
+    try:
+        os.rename(src, dest)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    # cross-device: GNU cp clones extents where the filesystems allow it (reflink) and copies otherwise
+    copied = False
+    if sys.platform.startswith("linux") and shutil.which("cp"):
+        copied = subprocess.run(["cp", "-a", "--reflink=auto", str(src), str(dest)]).returncode == 0
+        if not copied:
+            shutil.rmtree(dest, ignore_errors=True)
+    if not copied:
+        shutil.copytree(src, dest)
+    shutil.rmtree(src)
+
+
+def status_path(session_id: str) -> Path:
+    return ANNOTATIONS_DIR / f"{session_id}_status.json"
+
+
+def write_status(session_id: str, status: str, **extra: Any) -> None:
+    """Persist job status ("pending" / "done" / "error") polled via /session/{id}/status"""
+    path = status_path(session_id)
+    # write-then-rename so a concurrent poll never reads a half-written file
+    tmp = path.with_suffix(".tmp")
+    tmp.write_bytes(orjson.dumps({"session_id": session_id, "status": status, **extra}, option=orjson.OPT_INDENT_2))
+    os.replace(tmp, path)
+
+
+# session_id -> (session folder st_mtime_ns, persons mapping) for list_session_persons.
+# The folder mtime only changes when its direct entries do, so endpoints that edit
+# person folders also drop the entry explicitly.
+_persons_cache: Dict[str, Tuple[int, Dict[str, List[str]]]] = {}
+
+
 def list_session_persons(session_id: str) -> Dict[str, List[str]]:
     """Return mapping person_folder -> list of web URL paths (/temp/...) for a given session"""
     session_folder = TEMP_ROOT / session_id
-    if not session_folder.exists():
+    try:
+        mtime = session_folder.stat().st_mtime_ns
+    except FileNotFoundError:
         raise HTTPException(status_code=404, detail="Session not found")
+    cached = _persons_cache.get(session_id)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
     out: Dict[str, List[str]] = {}
-    for person_folder in sorted(session_folder.iterdir()):
-        if person_folder.is_dir():
-            images = []
-            for f in sorted(person_folder.iterdir()):
-                if f.is_file():
-                    images.append(f"/temp/{session_id}/{person_folder.name}/{f.name}")
-            out[person_folder.name] = images
+    # os.scandir carries the entry type from the directory listing, so no extra stat per entry
+    with os.scandir(session_folder) as it:
+        persons = sorted((e for e in it if e.is_dir(follow_symlinks=False)), key=lambda e: e.name)
+    for person in persons:
+        with os.scandir(person.path) as it:
+            images = sorted(e.name for e in it if e.is_file(follow_symlinks=False))
+        out[person.name] = [f"/temp/{session_id}/{person.name}/{name}" for name in images]
+    _persons_cache[session_id] = (mtime, out)
     return out
 
 
@@ -101,18 +509,60 @@ def list_session_persons(session_id: str) -> Dict[str, List[str]]:
 # Upload & process video (creates temp session folder with person_x subfolders)
 # ------------------------------
 @app.post("/upload_video/")
-async def upload_video(file: UploadFile = File(...)):
+async def upload_video(background_tasks: BackgroundTasks, file: UploadFile = File(...), target_fps: float = Form(0)):
     """
     - Save uploaded video to backend/uploads/<session_id>.mp4
-    - Run detection and write crops to frontend/temp/<session_id>/person_<id>/
-    - Return JSON with session_id and persons mapping
+    - Queue detection in a worker process (see process_video_job); target_fps > 0 samples the video
+      down to about that many frames per second (default: every frame)
+    - Return JSON with session_id; poll /session/<session_id>/status for the persons mapping
     """
     # Save uploaded video
     session_id = uuid.uuid4().hex
     upload_path = UPLOADS_DIR / f"{session_id}.mp4"
-    with open(upload_path, "wb") as f:
-        f.write(await file.read())
+    async with aiofiles.open(upload_path, "wb") as f:
+        # stream in 1 MiB chunks so memory stays flat regardless of video size
+        while chunk := await file.read(1 << 20):
+            await f.write(chunk)
+
+    write_status(session_id, "pending")
+    background_tasks.add_task(submit_video_job, session_id, upload_path, target_fps)
+    return JSONResponse({"session_id": session_id, "status": "pending"})
+
+
+def submit_video_job(session_id: str, upload_path: Path, target_fps: float = 0) -> None:
+    """Hand the video to the worker pool; a worker that dies mid-job still leaves an "error" status behind"""
+    def on_done(fut):
+        if fut.exception() is not None:
+            # the worker died without reaching process_video_job's own cleanup
+            shutil.rmtree(TEMP_ROOT / session_id, ignore_errors=True)
+            write_status(session_id, "error", detail=f"Processing failed: {fut.exception()}")
+
+    global video_pool
+    pool = video_pool
+    try:
+        fut = pool.submit(process_video_job, session_id, str(upload_path), target_fps)
+    except BrokenProcessPool:
+        # a worker died earlier (CUDA crash, OOM kill) and the pool refuses new work; start a fresh
+        # pool (once, even if several uploads hit it) and run this job there
+        with video_pool_lock:
+            if video_pool is pool:
+                pool.shutdown(wait=False)
+                video_pool = make_video_pool()
+            pool = video_pool
+        try:
+            fut = pool.submit(process_video_job, session_id, str(upload_path), target_fps)
+        except BrokenProcessPool as e:
+            write_status(session_id, "error", detail=f"Processing failed: worker pool unavailable ({e})")
+            return
+    fut.add_done_callback(on_done)
 
+
+def process_video_job(session_id: str, upload_path: str, target_fps: float = 0) -> None:
+    """
+    Runs in a worker process:
+    - Run detection and write crops to frontend/temp/<session_id>/person_<id>/
+    - Record the persons mapping (or the error) in annotations/<session_id>_status.json
+    """
     # Make temp session folder
     session_temp = TEMP_ROOT / session_id
     session_temp.mkdir(parents=True, exist_ok=True)
@@ -121,167 +571,137 @@ async def upload_video(file: UploadFile = File(...)):
     CONF_THRES = 0.35
     IOU_THRES = 0.5
     MIN_BOX_AREA = 25 * 25  # filter tiny boxes
-    SAMPLE_EVERY_N_FRAMES = 1  # process every frame (set >1 to skip frames)
 
-    # If YOLO model not available, return an empty session structure (but create temp folder)
+    # If YOLO model not available, finish with an empty session structure (but create temp folder)
+    model = get_model()
     if model is None:
-        return JSONResponse({"session_id": session_id, "persons": {}})
+        write_status(session_id, "done", persons={})
+        return
 
-    # Try to run tracker if available; fallback to per-frame detection if tracker not supported
-    use_tracking = True
-    try:
-        # try a small track run to check availability (no heavy cost)
-        # We'll use model.track streaming directly for the whole video below if supported.
-        _ = getattr(model, "track", None)
-        if _ is None:
-            use_tracking = False
-    except Exception:
-        use_tracking = False
+    # Batched detection + standalone ByteTrack if available; fallback to per-frame detection otherwise
+    use_tracking = BYTETracker is not None
 
-    person_map: Dict[str, List[str]] = {}
+    person_map: Dict[str, List[str]] = defaultdict(list)
+    failed_writes: List[Path] = []  # filled by the crop writer threads
 
-    # Helper to save crop and map to web path
-    def save_crop_and_map(person_key: str, crop_img, fname: str):
-        folder = session_temp / person_key
-        folder.mkdir(parents=True, exist_ok=True)
-        dst = folder / fname
-        cv2.imwrite(str(dst), crop_img)
+    # Helper to queue an encoded crop for writing and map it to its web path
+    def save_crop_and_map(person_key: str, jpeg: Optional[bytes], fname: str):
+        if jpeg is None:
+            return
+        dst = session_temp / person_key / fname
+        crop_queue.put((dst, jpeg, failed_writes))
         web = f"/temp/{session_id}/{person_key}/{fname}"
-        person_map.setdefault(person_key, []).append(web)
+        person_map[person_key].append(web)
 
-    try:
-        if use_tracking:
-            # Use YOLO's track (ByteTrack) - keeps consistent track IDs across frames if supported
-            # IMPORTANT: depending on ultralytics version you may need tracker config available.
-            stream = model.track(source=str(upload_path),
-                                 stream=True,
-                                 conf=CONF_THRES,
-                                 iou=IOU_THRES,
-                                 classes=[0],
-                                 tracker="bytetrack.yaml",
-                                 persist=True,
-                                 verbose=False)
-            frame_idx = 0
-            for result in stream:
-                try:
-                    frame = getattr(result, "orig_img", None)
-                    if frame is None:
-                        frame_idx += 1
-                        continue
-                    boxes = getattr(result, "boxes", None)
-                    if boxes is None:
-                        frame_idx += 1
-                        continue
+    # Helper to encode all of a frame's crops in one go; crops are (person_key, fname, (x1, y1, x2, y2))
+    def save_frame_crops(frame, crops: List[Tuple[str, str, Tuple[int, int, int, int]]]):
+        if not crops:
+            return
+        jpegs = encode_crops(frame, [box for _, _, box in crops])
+        for (person_key, fname, _), jpeg in zip(crops, jpegs):
+            save_crop_and_map(person_key, jpeg, fname)
 
-                    # extract ids and xyxy safely
-                    ids = getattr(boxes, "id", None)
-                    xyxy = getattr(boxes, "xyxy", None)
+    try:
+        # decoder yields every stride-th frame; batch size follows free VRAM (sized after the model is loaded)
+        fps, stride, video_frames = open_video(Path(upload_path), target_fps)
+        batch_size = pick_batch_size()
+        # no autograd bookkeeping for detection or GPU-side crop encoding
+        inference_mode = torch.inference_mode if torch is not None else nullcontext
 
-                    # convert to list/ndarray where possible
-                    ids_list = None
+        if use_tracking:
+            # Run YOLO on batch_size frames per forward pass, then feed each frame's detections
+            # to one ByteTrack instance so track IDs stay consistent across batches.
+            # The tracker sees the sampled rate, so its track_buffer still spans the same time.
+            sampled_fps = max(1, round(fps / stride)) if fps else 30
+            tracker = BYTETracker(TRACKER_ARGS, frame_rate=sampled_fps)
+
+            def track_batch(frames: List[Any], frame_ids: List[int]):
+                results = model(frames, conf=CONF_THRES, iou=IOU_THRES, classes=[0], verbose=False, **PREDICT_KWARGS)
+                for frame, frame_idx, r in zip(frames, frame_ids, results):
                     try:
-                        ids_list = ids.int().cpu().numpy().tolist() if ids is not None else []
-                    except Exception:
-                        # maybe it's a list already
-                        ids_list = list(ids) if ids is not None else []
+                        boxes = getattr(r, "boxes", None)
+                        if boxes is None:
+                            continue
 
-                    try:
-                        xyxy_np = xyxy.cpu().numpy() if xyxy is not None else None
+                        # tracks rows: x1, y1, x2, y2, track_id, score, cls, det_idx
+                        tracks = tracker.update(boxes.cpu().numpy(), frame)
+                        if len(tracks) == 0:
+                            continue
+                        h, w = frame.shape[:2]
+                        keep, xyxy = filter_boxes(tracks[:, :4], w, h, MIN_BOX_AREA)
+                        ids = tracks[keep, 4].astype(int).tolist()
+                        crops = []
+                        for tid, (x1, y1, x2, y2) in zip(ids, xyxy[keep].tolist()):
+                            person_key = f"person_{tid}"
+                            fname = f"f{frame_idx}_id{tid}.jpg"
+                            crops.append((person_key, fname, (x1, y1, x2, y2)))
+                        save_frame_crops(frame, crops)
                     except Exception:
-                        xyxy_np = xyxy
-
-                    if xyxy_np is None:
-                        frame_idx += 1
+                        # ignore frame-level issues but continue processing
                         continue
 
-                    h, w = frame.shape[:2]
-                    for i, tid in enumerate(ids_list):
-                        try:
-                            coords = xyxy_np[i]
-                            x1, y1, x2, y2 = map(int, coords.tolist())
-                        except Exception:
-                            continue
-                        # clamp and area filter
-                        x1 = max(0, min(x1, w - 1))
-                        x2 = max(0, min(x2, w - 1))
-                        y1 = max(0, min(y1, h - 1))
-                        y2 = max(0, min(y2, h - 1))
-                        if x2 <= x1 or y2 <= y1:
-                            continue
-                        if (x2 - x1) * (y2 - y1) < MIN_BOX_AREA:
-                            continue
-                        crop = frame[y1:y2, x1:x2]
-                        person_key = f"person_{int(tid)}"
-                        fname = f"f{frame_idx}_id{int(tid)}.jpg"
-                        save_crop_and_map(person_key, crop, fname)
-                    frame_idx += 1
-                except Exception:
-                    # ignore frame-level issues but continue processing
-                    frame_idx += 1
-                    continue
+            with inference_mode():
+                for frames, frame_ids in iter_batches(video_frames, batch_size):
+                    track_batch(frames, frame_ids)
 
         else:
-            # fallback: per-frame detection without tracking (assign new person ids incrementally)
-            cap = cv2.VideoCapture(str(upload_path))
-            fps = int(cap.get(cv2.CAP_PROP_FPS)) or 1
-            frame_idx = 0
+            # fallback: batched detection without tracking (assign new person ids incrementally)
             next_pid = 0
-            while True:
-                ret, frame = cap.read()
-                if not ret:
-                    break
-                if frame_idx % SAMPLE_EVERY_N_FRAMES == 0:
-                    # write one frame to disk for YOLO convenience
-                    tmp_frame_path = session_temp / f"frame_{frame_idx}.jpg"
-                    cv2.imwrite(str(tmp_frame_path), frame)
-                    results = model(str(tmp_frame_path), conf=CONF_THRES)
-                    if len(results) > 0:
-                        boxes = getattr(results[0], "boxes", None)
-                        if boxes:
-                            for r in boxes:
-                                try:
-                                    if int(r.cls[0].item()) != 0:
-                                        continue
-                                    x1, y1, x2, y2 = map(int, r.xyxy[0].tolist())
-                                except Exception:
-                                    continue
-                                h, w = frame.shape[:2]
-                                x1 = max(0, min(x1, w - 1))
-                                x2 = max(0, min(x2, w - 1))
-                                y1 = max(0, min(y1, h - 1))
-                                y2 = max(0, min(y2, h - 1))
-                                if x2 <= x1 or y2 <= y1:
-                                    continue
-                                if (x2 - x1) * (y2 - y1) < MIN_BOX_AREA:
-                                    continue
-                                crop = frame[y1:y2, x1:x2]
-                                person_key = f"person_{next_pid}"
-                                fname = f"f{frame_idx}_p{next_pid}.jpg"
-                                save_crop_and_map(person_key, crop, fname)
-                                next_pid += 1
-                frame_idx += 1
-            cap.release()
+
+            def detect_batch(frames: List[Any], frame_ids: List[int]):
+                nonlocal next_pid
+                # frames are passed as in-memory ndarrays (no JPEG round-trip through disk)
+                results = model(frames, conf=CONF_THRES, classes=[0], verbose=False, **PREDICT_KWARGS)
+                for frame, frame_idx, result in zip(frames, frame_ids, results):
+                    boxes = getattr(result, "boxes", None)
+                    if not boxes:
+                        continue
+                    h, w = frame.shape[:2]
+                    keep, xyxy = filter_boxes(boxes.xyxy.cpu().numpy(), w, h, MIN_BOX_AREA)
+                    crops = []
+                    for x1, y1, x2, y2 in xyxy[keep].tolist():
+                        person_key = f"person_{next_pid}"
+                        fname = f"f{frame_idx}_p{next_pid}.jpg"
+                        crops.append((person_key, fname, (x1, y1, x2, y2)))
+                        next_pid += 1
+                    save_frame_crops(frame, crops)
+
+            with inference_mode():
+                for frames, frame_ids in iter_batches(video_frames, batch_size):
+                    detect_batch(frames, frame_ids)
+
+        # Wait for queued crops to reach disk before publishing the session
+        crop_queue.join()
+
+        # drop crops that never reached disk so annotation.json only lists existing files
+        if failed_writes:
+            missing = {f"/temp/{p.relative_to(TEMP_ROOT).as_posix()}" for p in failed_writes}
+            print(f"WARNING: {len(missing)} crops failed to write for session {session_id}; dropping them.")
+            for person_key in list(person_map):
+                person_map[person_key] = [web for web in person_map[person_key] if web not in missing]
+                if not person_map[person_key]:
+                    del person_map[person_key]
+        person_map = dict(person_map)
 
         # Save session annotation.json inside temp folder
         ann_file = session_temp / "annotation.json"
-        with open(ann_file, "w") as f:
-            json.dump(person_map, f, indent=2)
+        ann_file.write_bytes(orjson.dumps(person_map, option=orjson.OPT_INDENT_2))
 
         # Also write a backend-side JSON summary (in annotations folder) for record
         summary_path = ANNOTATIONS_DIR / f"{session_id}_summary.json"
-        with open(summary_path, "w") as sf:
-            json.dump({"session_id": session_id, "persons": person_map}, sf, indent=2)
+        summary_path.write_bytes(orjson.dumps({"session_id": session_id, "persons": person_map}, option=orjson.OPT_INDENT_2))
 
-        return JSONResponse({"session_id": session_id, "persons": person_map})
+        write_status(session_id, "done", persons=person_map)
 
     except Exception as e:
-        # cleanup partial temp on error
+        # cleanup partial temp on error (after pending crops land, so they are not written back)
         try:
+            crop_queue.join()
             if session_temp.exists():
                 shutil.rmtree(session_temp, ignore_errors=True)
         except Exception:
             pass
-        raise HTTPException(status_code=500, detail=f"Processing failed: {e}") from e
+        write_status(session_id, "error", detail=f"Processing failed: {e}")
 
 
 # ------------------------------
@@ -292,9 +712,19 @@ def get_session_persons(session_id: str):
     return JSONResponse({"session_id": session_id, "persons": list_session_persons(session_id)})
 
 
+@app.get("/session/{session_id}/status")
+def get_session_status(session_id: str):
+    path = status_path(session_id)
+    if not path.exists():
+        raise HTTPException(status_code=404, detail="Session not found")
+    # the status file is already JSON; serve its bytes as-is
+    return Response(content=path.read_bytes(), media_type="application/json")
+
+
 @app.get("/sessions/")
 def list_sessions():
-    sessions = [p.name for p in TEMP_ROOT.iterdir() if p.is_dir()]
+    with os.scandir(TEMP_ROOT) as it:
+        sessions = [e.name for e in it if e.is_dir(follow_symlinks=False)]
     return JSONResponse({"sessions": sessions})
 
 
@@ -312,7 +742,8 @@ def add_person(payload: Dict = Body(...)):
         new_name = name.strip().replace(" ", "_")
     else:
         # auto next index
-        existing = [p.name for p in session_dir.iterdir() if p.is_dir() and p.name.startswith("person_")]
+        with os.scandir(session_dir) as it:
+            existing = [e.name for e in it if e.name.startswith("person_") and e.is_dir(follow_symlinks=False)]
         idx = 0
         for e in existing:
             try:
@@ -325,6 +756,7 @@ def add_person(payload: Dict = Body(...)):
     if new_folder.exists():
         raise HTTPException(status_code=400, detail="Person folder exists")
     new_folder.mkdir(parents=True, exist_ok=False)
+    _persons_cache.pop(session_id, None)
     return JSONResponse({"person": new_name})
 
 
@@ -336,21 +768,19 @@ def move_image(payload: Dict = Body(...)):
         raise HTTPException(status_code=400, detail="src and dest_person required")
     if not src.startswith("/temp/"):
         raise HTTPException(status_code=400, detail="Only /temp/ paths supported")
-    parts = src.split("/")
-    if len(parts) < 5:
-        raise HTTPException(status_code=400, detail="Invalid src path")
-    session_id = parts[2]
-    filename = parts[-1]
-    src_fs = TEMP_ROOT / session_id / parts[3] / filename
+    session_id, person, filename = parse_temp_web_path(src, "Invalid src path")
+    src_fs = safe_temp_path(session_id, person, filename, detail="Invalid src path")
     if not src_fs.exists():
         raise HTTPException(status_code=404, detail="Source file not found")
-    dest_folder_fs = TEMP_ROOT / session_id / dest_person
+    dest_folder_fs = safe_temp_path(session_id, dest_person, detail="Invalid dest_person")
     dest_folder_fs.mkdir(parents=True, exist_ok=True)
     dest_fs = dest_folder_fs / filename
     if dest_fs.exists():
         base, ext = os.path.splitext(filename)
         dest_fs = dest_folder_fs / f"{base}_{uuid.uuid4().hex[:6]}{ext}"
-    shutil.move(str(src_fs), str(dest_fs))
+    # src and dest are both under TEMP_ROOT/<session_id>/, i.e. one filesystem, so a plain rename suffices
+    os.rename(src_fs, dest_fs)
+    _persons_cache.pop(session_id, None)
     new_web = f"/temp/{session_id}/{dest_person}/{dest_fs.name}"
     return JSONResponse({"moved_to": new_web})
 
@@ -360,15 +790,12 @@ def delete_image(payload: Dict = Body(...)):
     path = payload.get("path")
     if not path or not path.startswith("/temp/"):
         raise HTTPException(status_code=400, detail="Invalid path")
-    parts = path.split("/")
-    if len(parts) < 5:
-        raise HTTPException(status_code=400, detail="Invalid path")
-    session_id = parts[2]
-    filename = parts[-1]
-    fs = TEMP_ROOT / session_id / parts[3] / filename
+    session_id, person, filename = parse_temp_web_path(path, "Invalid path")
+    fs = safe_temp_path(session_id, person, filename)
     if not fs.exists():
         raise HTTPException(status_code=404, detail="File not found")
     fs.unlink()
+    _persons_cache.pop(session_id, None)
     return JSONResponse({"deleted": path})
 
 
@@ -387,6 +814,7 @@ def rename_person(payload: Dict = Body(...)):
     if new_fs.exists():
         raise HTTPException(status_code=400, detail="Target name exists")
     old_fs.rename(new_fs)
+    _persons_cache.pop(session_id, None)
     return JSONResponse({"from": old_name, "to": new_name})
 
 
@@ -410,5 +838,6 @@ def confirm_session(payload: Dict = Body(...)):
             except Exception:
                 pass
     dest = PERSONS_DB / f"database_{n}"
-    shutil.move(str(src), str(dest))
+    move_tree(src, dest)
+    _persons_cache.pop(session_id, None)
     return JSONResponse({"moved_to": f"/persons/{dest.name}"})
@@ -45,8 +45,15 @@ uploadBtn.addEventListener('click', async () => {
     }
     const data = await res.json();
     currentSession = data.session_id;
+    statusEl.textContent = 'Processing...';
+    const job = await waitForSession(data.session_id);
+    if (job.status !== 'done') {
+      statusEl.textContent = 'Processing failed';
+      console.error(job);
+      return;
+    }
     statusEl.textContent = 'Processing complete — review below.';
-    renderPersonsGrid(data.persons);
+    renderPersonsGrid(job.persons);
     sessionControls.classList.remove('hidden');
   } catch (e) {
     console.error(e);
@@ -54,6 +61,20 @@ uploadBtn.addEventListener('click', async () => {
   }
 });
 
+// poll the background job until it finishes (status "done" or "error"); long videos can take a
+// long time, so keep waiting and show the elapsed time (the server fails jobs lost to a restart)
+async function waitForSession(sessionId, intervalMs = 1000) {
+  const started = Date.now();
+  while (true) {
+    const res = await fetch(`/session/${sessionId}/status`);
+    const job = await res.json();
+    if (!res.ok || job.status !== 'pending') return job;
+    const mins = Math.floor((Date.now() - started) / 60000);
+    statusEl.textContent = mins > 0 ? `Still processing... (${mins} min)` : 'Processing...';
+    await new Promise(r => setTimeout(r, intervalMs));
+  }
+}
+
 function renderPersonsGrid(persons) {
   personsGrid.innerHTML = '';
   moveToSelect.innerHTML = '<option value="">Move to...</option>';